@@ -8,21 +8,26 @@ What this app does:
 - Convert co2_kg → emissions_tonnes for readable KPIs.
 - Deduplicate to the latest record per facility_id (up to a moving time window).
 - Keep map view (center/zoom) across reruns so user zoom/pan is not lost.
-- Only reload file-data when the file's mtime actually changes.
+- Only reload file-data when the file's mtime or size actually changes.
 - Progressive playback (file-based): metrics grow over time instead of jumping to the end.
-- Cloud mode (MQTT direct): live updates via st.session_state, auto-refresh every N seconds.
+- Cloud mode (MQTT direct): live updates via st.session_state; polled every N seconds, redrawn only on new messages.
 """
 
 from __future__ import annotations
-import os, html, json, threading, time
+import os, html, json, threading, zlib
 from pathlib import Path
-from typing import Dict, Iterable, Any, Deque
-from collections import deque
+from typing import Dict, Iterable, Any
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.json as pa_json
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
+import pydeck as pdk
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_folium import st_folium
 
 
@@ -33,6 +38,18 @@ try:
 except Exception:
     _MQTT_AVAILABLE = False
 
+try:
+    import orjson  # faster JSON decode for MQTT payloads (accepts bytes)
+    _json_loads = orjson.loads
+except Exception:
+    _json_loads = json.loads  # stdlib also accepts bytes
+
+try:
+    import polars as pl  # lazy, multithreaded load + harmonise for file-based data
+    _POLARS_AVAILABLE = True
+except Exception:
+    _POLARS_AVAILABLE = False
+
 # -------------------------
 # Config
 # -------------------------
@@ -41,6 +58,8 @@ JSONL_PATH    = Path("output/sub_received.jsonl")
 CSV_PATH      = Path("data/cleaned_data_mqtt.csv")
 DEFAULT_CENTER = (-25.5, 134.5)  # AU-ish
 DEFAULT_ZOOM   = 4
+RENDERERS      = ("Folium (Leaflet)", "pydeck (WebGL)", "Leaflet (Arrow IPC)")
+COMPONENTS_DIR = Path(__file__).parent / "components"
 PLAYBACK_DELTA = pd.Timedelta(minutes=5)  # file-based playback granularity
 
 # Cloud / MQTT direct config (override via env)
@@ -74,33 +93,54 @@ def _valid_lat_lon(lat: Any, lon: Any) -> bool:
         la = float(lat); lo = float(lon)
     except Exception:
         return False
-    if pd.isna(la) or pd.isna(lo): return False
+    # NaN fails every comparison, so the range check also rejects missing coords (no pd.isna dispatch)
     if not (-90.0 <= la <= 90.0 and -180.0 <= lo <= 180.0): return False
     if abs(la) < 1e-9 and abs(lo) < 1e-9: return False
     return True
 
-def _mtime() -> float:
-    if JSONL_PATH.exists(): return JSONL_PATH.stat().st_mtime
-    if CSV_PATH.exists():   return CSV_PATH.stat().st_mtime
-    return 0.0
+def _valid_lat_lon_mask(lat: pd.Series, lon: pd.Series) -> np.ndarray:
+    """Vectorised _valid_lat_lon over numeric lat/lon columns."""
+    la = lat.to_numpy(dtype=float, na_value=np.nan)
+    lo = lon.to_numpy(dtype=float, na_value=np.nan)
+    return (
+        np.isfinite(la) & np.isfinite(lo)
+        & (la >= -90.0) & (la <= 90.0) & (lo >= -180.0) & (lo <= 180.0)
+        & ~((np.abs(la) < 1e-9) & (np.abs(lo) < 1e-9))
+    )
 
-def _harmonize(df: pd.DataFrame) -> pd.DataFrame:
-    """Unify schema and basic cleaning for file-based data."""
-    df = df.copy()
+def _active_path() -> Path | None:
+    if JSONL_PATH.exists(): return JSONL_PATH
+    if CSV_PATH.exists():   return CSV_PATH
+    return None
 
-    # coordinates
-    if "latitude" not in df.columns and "lat" in df.columns:
-        df["latitude"] = df["lat"]
-    if "longitude" not in df.columns and "lon" in df.columns:
-        df["longitude"] = df["lon"]
+# low-cardinality labels kept as pandas categoricals (int codes for isin/groupby/nunique)
+_CATEGORY_COLS = ("fuel_tech", "state", "region", "facility_id")
+# bounded, displayed with ≤3 decimals — float32 is plenty and halves the bytes every op touches
+_FLOAT32_COLS  = ("latitude", "longitude", "power_mw", "emissions_tonnes")
 
-    # names
-    if "name" not in df.columns and "facility_name" in df.columns:
-        df["name"] = df["facility_name"]
+def _compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    return df.assign(
+        **{c: df[c].astype("category") for c in _CATEGORY_COLS if c in df.columns},
+        **{c: df[c].astype("float32") for c in _FLOAT32_COLS if c in df.columns},
+    )
 
-    # power
-    if "power_mw" not in df.columns and "power" in df.columns:
-        df["power_mw"] = df["power"]
+# file column → app column (applied only when the app column is absent)
+_FILE_RENAMES = {
+    "lat": "latitude", "lon": "longitude",
+    "facility_name": "name", "facility_code": "facility_id",
+    "region": "state", "power": "power_mw", "time": "timestamp",
+}
+
+def _harmonize(df: pd.DataFrame) -> pd.DataFrame:
+    """Unify schema and basic cleaning for file-based data.
+
+    The caller hands over a freshly read frame, so it is renamed/assigned in
+    place of copying; the final coordinate filter materialises the result.
+    """
+    df = df.rename(columns={
+        src: dst for src, dst in _FILE_RENAMES.items()
+        if src in df.columns and dst not in df.columns
+    })
 
     # CO2 mass in kg → tonnes for display
     if "emissions_tonnes" not in df.columns:
@@ -111,43 +151,86 @@ def _harmonize(df: pd.DataFrame) -> pd.DataFrame:
         else:
             df["emissions_tonnes"] = None
 
-    # timestamp → _ts (UTC)
-    if "timestamp" not in df.columns and "time" in df.columns:
-        df["timestamp"] = df["time"]
-    df["_ts"] = pd.to_datetime(df.get("timestamp", pd.Series(dtype=str)), utc=True, errors="coerce")
+    # timestamp → _ts (UTC, ns) — parsed once on the ISO-8601 fast path, never re-coerced downstream
+    df["_ts"] = pd.to_datetime(
+        df.get("timestamp", pd.Series(dtype=str)), utc=True, format="ISO8601", errors="coerce"
+    ).dt.as_unit("ns")
 
     # ensure required cols exist
     for c in ["facility_id","name","state","fuel_tech","latitude","longitude","power_mw","timestamp"]:
         if c not in df.columns:
             df[c] = None
 
-    # numerics
-    for c in ["latitude","longitude","power_mw","emissions_tonnes"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
-
-    # sane coords only
-    df = df[df.apply(lambda r: _valid_lat_lon(r["latitude"], r["longitude"]), axis=1)]
-    return df
-
-def _popup(row: dict) -> str:
-    def n(v, default="-"):
-        if v is None: return default
-        if isinstance(v, float):
-            try: return f"{v:,.3f}"
-            except: return str(v)
-        return html.escape(str(v))
-    return (
-        "<div style='font-size:14px;line-height:1.45'>"
-        f"<b>{n(row.get('name'))}</b><br/>"
-        f"<b>ID:</b> {n(row.get('facility_id'))}<br/>"
-        f"<b>State:</b> {n(row.get('state'))} | <b>Fuel:</b> {n(row.get('fuel_tech'))}<br/>"
-        f"<b>Power (MW):</b> {n(row.get('power_mw'))} | "
-        f"<b>CO₂ (tCO₂e):</b> {n(row.get('emissions_tonnes'))}<br/>"
-        f"<b>Last Update:</b> {n(row.get('timestamp'))}"
-        "</div>"
+    # numerics (one pass)
+    df = df.assign(**{
+        c: pd.to_numeric(df[c], errors="coerce")
+        for c in ("latitude","longitude","power_mw","emissions_tonnes")
+    })
+
+    # sane coords and a parseable timestamp only (NaT rows could never enter the playback window)
+    df = df[_valid_lat_lon_mask(df["latitude"], df["longitude"]) & df["_ts"].notna().to_numpy()]
+
+    # time-ordered (stable) so the playback window is a prefix: df.iloc[:k]
+    df = df.sort_values("_ts", kind="mergesort", ignore_index=True)
+    return _compact_dtypes(df)
+
+def _harmonize_lazy(lf: "pl.LazyFrame") -> pd.DataFrame:
+    """Polars twin of _harmonize: same output frame, built as one lazy query."""
+    cols = lf.collect_schema().names()
+    ren = {src: dst for src, dst in _FILE_RENAMES.items() if src in cols and dst not in cols}
+    lf = lf.rename(ren)
+    cols = [ren.get(c, c) for c in cols]
+
+    exprs = []
+    if "emissions_tonnes" not in cols:
+        co2 = "co2_kg" if "co2_kg" in cols else ("emissions" if "emissions" in cols else None)
+        exprs.append((pl.col(co2).cast(pl.Float64, strict=False) / 1000.0 if co2 else pl.lit(None, pl.Float64))
+                     .alias("emissions_tonnes"))
+    for c in ["facility_id","name","state","fuel_tech","latitude","longitude","power_mw","timestamp"]:
+        if c not in cols:
+            exprs.append(pl.lit(None).alias(c))
+    lf = lf.with_columns(exprs).with_columns(
+        [pl.col(c).cast(pl.Float64, strict=False) for c in ("latitude","longitude","power_mw","emissions_tonnes")]
+        + [pl.col("timestamp").cast(pl.String).str.to_datetime(time_unit="ns", time_zone="UTC", strict=False).alias("_ts")]
     )
+    lat, lon = pl.col("latitude"), pl.col("longitude")
+    lf = lf.filter(
+        lat.is_finite() & lon.is_finite() & lat.is_between(-90.0, 90.0) & lon.is_between(-180.0, 180.0)
+        & ~((lat.abs() < 1e-9) & (lon.abs() < 1e-9)) & pl.col("_ts").is_not_null()
+    ).sort("_ts", maintain_order=True)
+    return _compact_dtypes(lf.collect().to_pandas())
+
+@st.cache_data(show_spinner=False, ttl=None, max_entries=4)
+def _load_harmonized(path: str, mtime: float, size: int) -> pd.DataFrame:
+    """Read + harmonise a data file. mtime/size are only cache keys (cheap to hash)."""
+    if size == 0:  # e.g. subscriber just created the JSONL
+        return pd.DataFrame()
+    if _POLARS_AVAILABLE:
+        lf = pl.scan_ndjson(path, infer_schema_length=None) if path.endswith(".jsonl") else pl.scan_csv(path)
+        return _harmonize_lazy(lf)
+    # Arrow parses straight into columns (no per-record Python dicts)
+    if path.endswith(".jsonl"):
+        tbl = pa_json.read_json(path, read_options=pa_json.ReadOptions(use_threads=True, block_size=1 << 20))
+    else:
+        tbl = pa_csv.read_csv(path, read_options=pa_csv.ReadOptions(use_threads=True))
+    raw = tbl.to_pandas()
+    return _harmonize(raw) if not raw.empty else pd.DataFrame()
+
+_EPOCH = pd.Timestamp(0, tz="UTC")
+_HTML_ESCAPES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"), ("'", "&#x27;"))
+
+def _esc(s: pd.Series) -> pd.Series:
+    """Column-wise html.escape; missing values render as '-'."""
+    out = s.astype(str)
+    for ch, ent in _HTML_ESCAPES:
+        out = out.str.replace(ch, ent, regex=False)
+    return out.where(s.notna(), "-")
 
-def _legend(m: folium.Map, cmap: Dict[str, str]) -> None:
+def _num(s: pd.Series) -> pd.Series:
+    v = pd.to_numeric(s, errors="coerce")
+    return v.map("{:,.3f}".format).where(v.notna(), "-")
+
+def _legend_html(cmap: Dict[str, str]) -> str:
     items = "".join(f"<li><span style='background:{c};'></span>{html.escape(k)}</li>" for k,c in cmap.items())
     html_legend = f"""
     <div id="legend" style="position: fixed; bottom: 18px; left: 18px;
@@ -161,28 +244,174 @@ def _legend(m: folium.Map, cmap: Dict[str, str]) -> None:
       #legend ul li span {{ width:12px; height:12px; border-radius:50%; display:inline-block; border:1px solid rgba(0,0,0,.25); }}
     </style>
     """
-    m.get_root().html.add_child(folium.Element(html_legend))
-
-def _markers(m: folium.Map, df: pd.DataFrame, cmap: Dict[str, str]) -> None:
-    cluster = MarkerCluster(disableClusteringAtZoom=9).add_to(m)
-    for _, r in df.iterrows():
-        col = cmap.get(r.get("fuel_tech","Unknown"), "#BAB0AC")
-        pw  = float(r.get("power_mw") or 0.0)
-        radius = max(4, min(12, (pw if pw > 0 else 4) ** 0.5 + 4))
-        folium.CircleMarker(
-            location=(float(r["latitude"]), float(r["longitude"])),
-            radius=radius, color="#2b2b2b", weight=0.8,
-            fill=True, fill_color=col, fill_opacity=0.88,
-            tooltip=f"{r.get('name','Unknown')} | {r.get('fuel_tech','')}",
-            popup=folium.Popup(_popup(r), max_width=360),
-        ).add_to(cluster)
-    folium.LayerControl(collapsed=False).add_to(m)
+    return html_legend
+
+@st.cache_data(show_spinner=False)
+def _cmap_and_legend_html(fuels: tuple[str, ...]) -> tuple[Dict[str, str], str]:
+    """Colour map + legend markup for a fuel set; the set rarely changes between reruns."""
+    cmap = make_color_map(fuels)
+    return cmap, _legend_html(cmap)
+
+def _legend(m: folium.Map, legend_html: str) -> None:
+    m.get_root().html.add_child(folium.Element(legend_html))
+
+# Leaflet-side marker factory; each data row is raw columns
+# [lat, lon, radius, fill, name, fuel, facility_id, state, power_mw, emissions_tonnes, ts_ms].
+# Tooltip/popup HTML is formatted in the browser, the popup only when it is first opened.
+_MARKER_CALLBACK = """
+(function () {
+    var ENT = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"};
+    function esc(v) { return v == null ? "-" : String(v).replace(/[&<>"']/g, function (c) { return ENT[c]; }); }
+    function num(v) {
+        return v == null || isNaN(v) ? "-"
+            : Number(v).toLocaleString("en-US", {minimumFractionDigits: 3, maximumFractionDigits: 3});
+    }
+    return function (row) {
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+            radius: row[2], color: "#2b2b2b", weight: 0.8,
+            fill: true, fillColor: row[3], fillOpacity: 0.88
+        });
+        marker.bindTooltip(esc(row[4] == null ? "Unknown" : row[4]) + " | " + esc(row[5] == null ? "" : row[5]));
+        marker.bindPopup(function () {
+            return "<div style='font-size:14px;line-height:1.45'>" +
+                "<b>" + esc(row[4]) + "</b><br/>" +
+                "<b>ID:</b> " + esc(row[6]) + "<br/>" +
+                "<b>State:</b> " + esc(row[7]) + " | <b>Fuel:</b> " + esc(row[5]) + "<br/>" +
+                "<b>Power (MW):</b> " + num(row[8]) + " | <b>CO₂ (tCO₂e):</b> " + num(row[9]) + "<br/>" +
+                "<b>Last Update:</b> " + (row[10] == null ? "-" : new Date(row[10]).toISOString().replace(".000", "")) +
+                "</div>";
+        }, {maxWidth: 360});
+        return marker;
+    };
+})()"""
+
+def _nullable(s: pd.Series) -> list:
+    """Column as a JSON-ready list (NaN/NaT/missing → None)."""
+    return s.astype(object).where(s.notna(), None).tolist()
+
+def _marker_style(df: pd.DataFrame, cmap: Dict[str, str]) -> tuple[np.ndarray, pd.Series]:
+    """Per-row marker radius (px, scaled by √power) and fill colour."""
+    pw = df["power_mw"].fillna(0.0).to_numpy(dtype=float)
+    radius = np.clip(np.sqrt(np.where(pw > 0, pw, 4.0)) + 4, 4, 12)
+    colors = df["fuel_tech"].astype(object).map(cmap).fillna("#BAB0AC")
+    return radius, colors
+
+def _markers(layer: folium.FeatureGroup, df: pd.DataFrame, cmap: Dict[str, str]) -> None:
+    radius, colors = _marker_style(df, cmap)
+    ts_ms = ((df["_ts"] - _EPOCH) // pd.Timedelta(milliseconds=1))
+    data = list(zip(
+        df["latitude"].tolist(), df["longitude"].tolist(), radius.tolist(), colors.tolist(),
+        _nullable(df["name"]), _nullable(df["fuel_tech"]), _nullable(df["facility_id"]), _nullable(df["state"]),
+        _nullable(df["power_mw"].astype(float)), _nullable(df["emissions_tonnes"].astype(float)), _nullable(ts_ms),
+    ))
+    FastMarkerCluster(data, callback=_MARKER_CALLBACK, disableClusteringAtZoom=9).add_to(layer)
+
+_DECK_TOOLTIP = (
+    "<div style='font-size:14px;line-height:1.45'><b>{name}</b><br/><b>ID:</b> {facility_id}<br/>"
+    "<b>State:</b> {state} | <b>Fuel:</b> {fuel_tech}<br/>"
+    "<b>Power (MW):</b> {power_mw} | <b>CO₂ (tCO₂e):</b> {emissions_tonnes}<br/>"
+    "<b>Last Update:</b> {last_update}</div>"
+)
+
+def _deck(df: pd.DataFrame, cmap: Dict[str, str], center: tuple, zoom: int) -> pdk.Deck:
+    """Same markers as _markers, drawn by deck.gl on the GPU from one columnar table."""
+    radius, colors = _marker_style(df, cmap)
+    rgb = {c: [int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in colors.unique()}
+    data = pd.DataFrame({
+        "longitude": df["longitude"].to_numpy(dtype=float),
+        "latitude": df["latitude"].to_numpy(dtype=float),
+        "_radius": radius,
+        "_rgb": colors.map(rgb).to_numpy(),
+        # plain per-field text; deck.gl substitutes it into _DECK_TOOLTIP on hover
+        "name": _esc(df["name"]).to_numpy(),
+        "facility_id": _esc(df["facility_id"]).to_numpy(),
+        "state": _esc(df["state"]).to_numpy(),
+        "fuel_tech": _esc(df["fuel_tech"]).to_numpy(),
+        "power_mw": _num(df["power_mw"]).to_numpy(),
+        "emissions_tonnes": _num(df["emissions_tonnes"]).to_numpy(),
+        "last_update": _esc(df["_ts"].dt.strftime("%Y-%m-%dT%H:%M:%SZ")).to_numpy(),
+    })
+    layer = pdk.Layer(
+        "ScatterplotLayer", data=data,
+        get_position=["longitude", "latitude"], get_radius="_radius", radius_units="'pixels'",
+        get_fill_color="_rgb", opacity=0.88, stroked=True, get_line_color=[43, 43, 43],
+        line_width_units="'pixels'", get_line_width=0.8, pickable=True,
+    )
+    return pdk.Deck(
+        layers=[layer], map_style="light",
+        initial_view_state=pdk.ViewState(latitude=center[0], longitude=center[1], zoom=zoom),
+        tooltip={"html": _DECK_TOOLTIP},
+    )
+
+# Leaflet drawn in the browser from an Arrow IPC stream (see components/arrow_map/index.html)
+_arrow_map = components.declare_component("arrow_map", path=str(COMPONENTS_DIR / "arrow_map"))
+
+def _arrow_payload(df: pd.DataFrame) -> bytes:
+    """Marker columns as one Arrow IPC stream; popups/tooltips/radius are built client-side."""
+    table = pa.table({
+        "latitude": df["latitude"].to_numpy(dtype=float),
+        "longitude": df["longitude"].to_numpy(dtype=float),
+        "power_mw": df["power_mw"].to_numpy(dtype=float),
+        "emissions_tonnes": df["emissions_tonnes"].to_numpy(dtype=float),
+        "ts_ms": ((df["_ts"] - _EPOCH) / pd.Timedelta(milliseconds=1)).to_numpy(dtype=float),  # NaT → NaN
+        **{c: pa.array(df[c].astype(object), type=pa.string(), from_pandas=True)  # missing → null
+           for c in ("fuel_tech", "facility_id", "name", "state")},
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+class _LiveStore:
+    """Latest record per facility for cloud mode, kept column-wise (one array per field).
+
+    Written by the MQTT network thread (passed as client userdata), read by the
+    script thread; a facility keeps its row slot, so updates are in place.
+    `version` is bumped on every accepted message so readers can tell if anything changed.
+    """
+    NUM_COLS = ("latitude", "longitude", "power_mw", "co2_kg")
+    STR_COLS = ("facility_id", "facility_code", "name", "state", "region", "fuel_tech", "timestamp")
+
+    def __init__(self, capacity: int = 512):
+        self.lock = threading.Lock()
+        self.idx: Dict[str, int] = {}
+        self.n = 0
+        self.version = 0
+        self.cols: Dict[str, np.ndarray] = {c: np.full(capacity, np.nan, dtype=np.float32) for c in self.NUM_COLS}
+        self.cols |= {c: np.empty(capacity, dtype=object) for c in self.STR_COLS}
+
+    def _slot(self, key: str) -> int:
+        i = self.idx.get(key)
+        if i is None:
+            i = self.n
+            if i == len(self.cols["latitude"]):  # grow ×2
+                self.cols = {c: np.concatenate([a, np.full_like(a, np.nan if a.dtype.kind == "f" else None)])
+                             for c, a in self.cols.items()}
+            self.idx[key] = i
+            self.n += 1
+        return i
+
+    def upsert(self, rec: Dict[str, Any]) -> None:
+        with self.lock:
+            i = self._slot(rec["facility_code"])
+            for c in self.NUM_COLS:
+                try:
+                    self.cols[c][i] = float(rec.get(c))
+                except (TypeError, ValueError):
+                    self.cols[c][i] = np.nan
+            for c in self.STR_COLS:
+                self.cols[c][i] = rec.get(c)
+            self.version += 1
+
+    def to_frame(self) -> pd.DataFrame:
+        with self.lock:
+            return pd.DataFrame({c: a[:self.n] for c, a in self.cols.items()})
 
 # -------------------------
 # Session state (shared)
 # -------------------------
-if "data_mtime" not in st.session_state:
-    st.session_state.data_mtime = -1.0
+if "data_key" not in st.session_state:
+    st.session_state.data_key = None  # (path, mtime, size) of the file behind df_all
 if "df_all" not in st.session_state:
     st.session_state.df_all = pd.DataFrame()
 if "map_view" not in st.session_state:
@@ -195,10 +424,8 @@ if "mqtt_started" not in st.session_state:
     st.session_state.mqtt_started = False
 if "mqtt_status" not in st.session_state:
     st.session_state.mqtt_status = "idle"
-if "msg_buf" not in st.session_state:
-    st.session_state.msg_buf = deque(maxlen=20000)
-if "latest_by_fac" not in st.session_state:
-    st.session_state.latest_by_fac = {} 
+if "live_store" not in st.session_state:
+    st.session_state.live_store = _LiveStore()
 
 # -------------------------
 # Sidebar controls
@@ -214,9 +441,12 @@ with st.sidebar:
     play = st.checkbox("Progressive reveal (file-based)", value=True, key="play_flag")
     speed = st.slider("Playback speed (sec per tick)", 0.2, 3.0, 1.0, 0.1, key="play_speed")
     refresh_every = st.slider("Auto-refresh (cloud mode, seconds)", 1, 10, 2, 1, key="refresh_interval")
+    renderer = st.radio("Map renderer", RENDERERS, index=0, key="map_renderer")
 
     if st.button("Manual Refresh (file-based)", key="btn_manual_refresh"):
-        st.session_state.data_mtime = -1.0
+        _load_harmonized.clear()  # the file key may be unchanged; force a real re-read
+        st.session_state.data_key = None
+        st.session_state.pop("df_key_seen", None)  # … and rebuild the playback index from it
         st.rerun()
 
 # ---------- Decide data mode ----------
@@ -228,47 +458,12 @@ CLOUD_MODE = cloud_force or cloud_mode_auto
 # -------------------------
 # CLOUD MODE: MQTT background subscriber
 # -------------------------
-def _to_df_from_latest(latest: dict[str, dict]) -> pd.DataFrame:
-    if not latest:
-        return pd.DataFrame(columns=[
-            "facility_id","facility_code","name","facility_name","state","region",
-            "fuel_tech","latitude","longitude","power_mw","co2_kg","emissions_tonnes","timestamp","_ts"
-        ])
-    df = pd.DataFrame(latest.values()).copy()
-
-    # schema harmonisation for live records
-    if "facility_id" not in df.columns:
-        df["facility_id"] = df.get("facility_code") or df.get("code")
-    if "name" not in df.columns:
-        df["name"] = df.get("facility_name")
-    if "power_mw" not in df.columns and "power" in df.columns:
-        df["power_mw"] = df["power"]
-    if "co2_kg" not in df.columns and "emissions" in df.columns:
-        df["co2_kg"] = df["emissions"]
-
-    # emissions tonnes
-    df["emissions_tonnes"] = pd.to_numeric(df.get("co2_kg"), errors="coerce") / 1000.0
-
-    # timestamp
-    ts_col = "timestamp" if "timestamp" in df.columns else ("ts" if "ts" in df.columns else None)
-    if ts_col:
-        df["_ts"] = pd.to_datetime(df[ts_col], utc=True, errors="coerce")
-        df["timestamp"] = df[ts_col]
-    else:
-        df["_ts"] = pd.NaT
-
-    # numerics & coords
-    for c in ("latitude","longitude","power_mw"):
-        if c in df:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-    if "latitude" in df and "longitude" in df:
-        df = df[df.apply(lambda r: _valid_lat_lon(r["latitude"], r["longitude"]), axis=1)]
-
-    # fill essentials
-    for c in ["facility_id","name","state","fuel_tech","latitude","longitude","power_mw","timestamp"]:
-        if c not in df.columns: df[c] = None
-
-    return df
+def _to_df_from_latest(store: _LiveStore) -> pd.DataFrame:
+    # columns come straight from the store arrays; coords were validated on arrival
+    df = store.to_frame()
+    df["emissions_tonnes"] = df["co2_kg"] / 1000.0
+    df["_ts"] = pd.to_datetime(df["timestamp"], utc=True, format="ISO8601", errors="coerce")
+    return _compact_dtypes(df)
 
 def _mqtt_on_connect(client, userdata, flags, rc):
     st.session_state.mqtt_status = f"connected rc={rc}"
@@ -276,9 +471,11 @@ def _mqtt_on_connect(client, userdata, flags, rc):
 
 def _mqtt_on_message(client, userdata, msg):
     try:
-        j = json.loads(msg.payload.decode("utf-8", errors="ignore"))
+        j = _json_loads(msg.payload)
     except Exception:
         return
+    if not isinstance(j, dict):
+        return
     # normalise keys
     fc = j.get("facility_code") or j.get("facility_id") or j.get("code")
     if not fc:
@@ -297,18 +494,20 @@ def _mqtt_on_message(client, userdata, msg):
         "co2_kg": j.get("co2_kg") if "co2_kg" in j else (j.get("emissions") or j.get("co2")),
         "timestamp": j.get("timestamp") or j.get("ts"),
     }
-    st.session_state.msg_buf.append(rec)
-    st.session_state.latest_by_fac[fc] = rec
+    if not _valid_lat_lon(rec["latitude"], rec["longitude"]):
+        return
+    userdata.upsert(rec)
 
 def _start_mqtt_once():
     if st.session_state.mqtt_started or not _MQTT_AVAILABLE:
         return
     st.session_state.mqtt_started = True
     st.session_state.mqtt_status = "connecting…"
+    store = st.session_state.live_store
 
     def _run():
         try:
-            client = mqtt.Client()  # v1 API works cross-env
+            client = mqtt.Client(userdata=store)  # v1 API works cross-env
             client.on_connect = _mqtt_on_connect
             client.on_message = _mqtt_on_message
             client.connect(BROKER, PORT, keepalive=60)
@@ -319,28 +518,49 @@ def _start_mqtt_once():
     th = threading.Thread(target=_run, daemon=True)
     th.start()
 
+def _watch_live_store() -> None:
+    """Poll the live store in a fragment; rerun the full app (map, KPIs) only when
+    new MQTT messages arrived, instead of rebuilding everything on a fixed timer."""
+    @st.fragment(run_every=float(st.session_state.get("refresh_interval", 2)))
+    def _poll():
+        if st.session_state.live_store.version != st.session_state.get("live_version_seen"):
+            st.rerun()
+    _poll()
+
+def _playback_tick(interval: float) -> None:
+    """Advance file playback without blocking the script thread: a fragment timer
+    fires after `interval` seconds and reruns the full app (which moves the head)."""
+    st.session_state.playback_armed = False
+    @st.fragment(run_every=interval)
+    def _tick():
+        if st.session_state.playback_armed:  # skip the inline run during the full-app pass
+            st.rerun()
+        st.session_state.playback_armed = True
+    _tick()
+
 # -------------------------
 # Data source selection
 # -------------------------
 if CLOUD_MODE and _MQTT_AVAILABLE:
     # Cloud / live mode
     _start_mqtt_once()
-    df_all = _to_df_from_latest(st.session_state.latest_by_fac)
+    st.session_state.live_version_seen = st.session_state.live_store.version
+    df_all = _to_df_from_latest(st.session_state.live_store)
     file_based = False
     # In live mode, playback doesn't make sense
     play = False
 else:
     # File-based mode (JSONL preferred, else CSV)
-    mt = _mtime()
-    if not st.session_state.get("pause_update", False) and mt != st.session_state.data_mtime:
-        if JSONL_PATH.exists():
-            raw = pd.read_json(JSONL_PATH, lines=True)
-        elif CSV_PATH.exists():
-            raw = pd.read_csv(CSV_PATH)
+    if not st.session_state.get("pause_update", False):
+        src = _active_path()
+        if src is not None:
+            stat = src.stat()
+            key = (str(src), stat.st_mtime, stat.st_size)  # same key _load_harmonized caches on
+            st.session_state.df_all = _load_harmonized(*key)
+            st.session_state.data_key = key
         else:
-            raw = pd.DataFrame()
-        st.session_state.df_all = _harmonize(raw) if not raw.empty else pd.DataFrame()
-        st.session_state.data_mtime = mt
+            st.session_state.df_all = pd.DataFrame()
+            st.session_state.data_key = None
     df_all = st.session_state.df_all
     file_based = True
 
@@ -355,17 +575,26 @@ if df_all.empty:
     st.info("Waiting for data… Start publisher, or enable cloud mode to subscribe directly.")
     m = folium.Map(location=DEFAULT_CENTER, zoom_start=DEFAULT_ZOOM, tiles="cartodbpositron")
     st_folium(m, height=640, use_container_width=True, key="folium_empty")
-    # In live mode, auto refresh to pull arriving messages
-    if CLOUD_MODE:
-        st.autorefresh(interval=int(st.session_state.get("refresh_interval", 2)) * 1000, key="poll-empty")
+    # In live mode, poll for arriving messages
+    if CLOUD_MODE and _MQTT_AVAILABLE:
+        _watch_live_store()
     st.stop()
 
 # -------------------------
 # Progressive time window (file-based only)
 # -------------------------
 if file_based:
-    min_ts = pd.to_datetime(df_all["_ts"]).min()
-    max_ts = pd.to_datetime(df_all["_ts"]).max()
+    # df_all is sorted by _ts (see _harmonize); only re-extract when a new file version was loaded
+    if st.session_state.get("df_key_seen") != st.session_state.data_key:
+        st.session_state.ts_int = df_all["_ts"].array.asi8  # epoch ns, ascending
+        st.session_state.ts_min = df_all["_ts"].iloc[0]
+        st.session_state.ts_max = df_all["_ts"].iloc[-1]
+        st.session_state.fid_codes = df_all["facility_id"].cat.codes.to_numpy()  # int keys, not strings
+        st.session_state.latest_idx = {}  # facility_id code → row position of its latest record so far
+        st.session_state.last_window_k = 0
+        st.session_state.df_key_seen = st.session_state.data_key
+    min_ts = st.session_state.ts_min
+    max_ts = st.session_state.ts_max
 
     if st.session_state.show_upto_ts is None or pd.isna(st.session_state.show_upto_ts):
         st.session_state.show_upto_ts = min_ts
@@ -373,17 +602,23 @@ if file_based:
     if play and st.session_state.show_upto_ts < max_ts:
         st.session_state.show_upto_ts = min(
             max_ts,
-            pd.to_datetime(st.session_state.show_upto_ts) + PLAYBACK_DELTA
+            st.session_state.show_upto_ts + PLAYBACK_DELTA
         )
 
-    df_window = df_all[df_all["_ts"] <= st.session_state.show_upto_ts].copy()
-    if not df_window.empty:
-        df_latest = df_window.sort_values("_ts").groupby("facility_id", as_index=False).tail(1)
-    else:
-        df_latest = df_window
+    # binary search for the window end instead of masking the whole column
+    k = int(np.searchsorted(st.session_state.ts_int, st.session_state.show_upto_ts.value, side="right"))
+    # incremental "latest per facility": only fold in the rows that entered since the last tick
+    if k < st.session_state.last_window_k:
+        st.session_state.latest_idx, st.session_state.last_window_k = {}, 0
+    last_k = st.session_state.last_window_k
+    latest_idx = st.session_state.latest_idx
+    latest_idx.update(zip(st.session_state.fid_codes[last_k:k].tolist(), range(last_k, k)))  # later rows win
+    st.session_state.last_window_k = k
+    rows = np.sort(np.fromiter(latest_idx.values(), dtype=np.int64, count=len(latest_idx)))
+    df_latest = df_all.iloc[rows].reset_index(drop=True)
 else:
-    # live mode: latest_by_fac is already "latest"
-    df_latest = df_all.copy()
+    # live mode: the live store is already "latest"
+    df_latest = df_all  # read-only from here on; no defensive copy
 
 # -------------------------
 # KPIs
@@ -392,7 +627,7 @@ def _fmt(x):
     try: return f"{x:,.1f}"
     except: return "-"
 
-latest_ts = pd.to_datetime(df_latest["_ts"]).max() if "_ts" in df_latest.columns and not df_latest.empty else None
+latest_ts = df_latest["_ts"].max() if "_ts" in df_latest.columns and not df_latest.empty else None
 c1, c2, c3 = st.columns(3)
 c1.metric("Facilities", f"{df_latest['facility_id'].nunique() if not df_latest.empty else 0}")
 c2.metric("Total Power (MW)", _fmt(df_latest["power_mw"].fillna(0).sum() if not df_latest.empty else 0))
@@ -402,7 +637,7 @@ st.caption(f"Last update: {latest_ts if latest_ts is not None else '-'}")
 # -------------------------
 # Filter (single multiselect, unique key)
 # -------------------------
-fuels = sorted([x for x in df_all["fuel_tech"].dropna().unique().tolist() if x]) if "fuel_tech" in df_all.columns else []
+fuels = [x for x in df_all["fuel_tech"].cat.categories.tolist() if x] if "fuel_tech" in df_all.columns else []
 selected = st.multiselect("Filter by fuel type", options=fuels, default=fuels, key="fuel_select_1")
 plot_df = df_latest[df_latest["fuel_tech"].isin(selected)] if selected else (df_latest if fuels else df_latest.iloc[0:0])
 
@@ -411,12 +646,37 @@ plot_df = df_latest[df_latest["fuel_tech"].isin(selected)] if selected else (df_
 # -------------------------
 center = tuple(st.session_state.map_view.get("center", list(DEFAULT_CENTER)))
 zoom   = int(st.session_state.map_view.get("zoom", DEFAULT_ZOOM))
-m = folium.Map(location=center, zoom_start=zoom, tiles="cartodbpositron")
-cmap = make_color_map(plot_df["fuel_tech"].tolist() if "fuel_tech" in plot_df.columns else ["Unknown"])
-_markers(m, plot_df, cmap)
-_legend(m, cmap)
+cmap, legend_html = _cmap_and_legend_html(
+    tuple(plot_df["fuel_tech"].cat.remove_unused_categories().cat.categories) if "fuel_tech" in plot_df.columns else ("Unknown",)
+)
+
+if renderer == RENDERERS[1]:
+    # WebGL path: one columnar payload, no per-marker HTML objects; view follows the last folium view
+    st.pydeck_chart(_deck(plot_df, cmap, center, zoom), height=680, use_container_width=True)
+    st.markdown(" &nbsp; ".join(
+        f"<span style='color:{c}'>●</span> {html.escape(k)}" for k, c in cmap.items()
+    ), unsafe_allow_html=True)
+    ret = None
+elif renderer == RENDERERS[2]:
+    # Binary columnar payload; the component keeps its Leaflet map and redraws only the markers
+    ret = _arrow_map(
+        data=_arrow_payload(plot_df), cmap=cmap, center=list(center), zoom=zoom,
+        height=680, key="arrow_map", default=None,
+    )
+else:
+    # The base map (tiles + legend) is identical across reruns, so st_folium keeps the mounted
+    # Leaflet map and only swaps the marker feature group; center/zoom are applied client-side.
+    m = folium.Map(location=DEFAULT_CENTER, zoom_start=DEFAULT_ZOOM, tiles="cartodbpositron")
+    _legend(m, legend_html)
+    fg = folium.FeatureGroup(name="Facilities")
+    _markers(fg, plot_df, cmap)
+    ret = st_folium(
+        m, center=center, zoom=zoom,
+        feature_group_to_add=fg, layer_control=folium.LayerControl(collapsed=False),
+        height=680, use_container_width=True,
+        key=f"folium_map_v1_{zlib.crc32(legend_html.encode()):08x}",  # remount only when the legend changes
+    )
 
-ret = st_folium(m, height=680, use_container_width=True, key="folium_map_v1")
 if isinstance(ret, dict):
     new_center = ret.get("center") or ret.get("last_center")
     new_zoom   = ret.get("zoom")
@@ -430,13 +690,9 @@ if isinstance(ret, dict):
 # Tick & rerun
 # -------------------------
 if file_based:
-    # Sleep = UI tick duration; keeps user interactions usable while the head advances.
-    time.sleep(float(st.session_state.get("play_speed", 1.0)))
-    if st.session_state.get("play_flag", False) and not df_all.empty:
-        # If still playing and not yet at the end, rerun to animate forward
-        max_ts_all = pd.to_datetime(df_all["_ts"]).max()
-        if st.session_state.show_upto_ts < max_ts_all:
-            st.rerun()
+    # Still playing and not yet at the end: schedule the next tick (the server thread stays free)
+    if play and not df_all.empty and st.session_state.show_upto_ts < st.session_state.ts_max:
+        _playback_tick(float(speed))
 else:
-    # Cloud/live mode: periodic auto-refresh pulls newly arrived messages from background MQTT
-    st.autorefresh(interval=int(st.session_state.get("refresh_interval", 2)) * 1000, key="poll-live")
+    # Cloud/live mode: rerun only once the background MQTT thread delivered something new
+    _watch_live_store()
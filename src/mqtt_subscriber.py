@@ -5,23 +5,158 @@ Subscribes to a topic and appends clean JSON lines to a file.
 - Only writes when payload is a valid JSON object.
 - Mirrors lat/lon to latitude/longitude if needed.
 - Keeps the same schema fields used by the publisher.
+- Buffers lines and writes them in batches (every 256 lines or 1s).
+- On Linux with `liburing` installed, batches are submitted through io_uring.
 """
 from __future__ import annotations
-import argparse, json, sys
+import argparse, json, os, sys, threading
 from pathlib import Path
 from datetime import datetime
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson  # faster JSON decode/encode straight from/to bytes
+    _json_loads, _json_dumps = orjson.loads, orjson.dumps
+except Exception:
+    _json_loads = json.loads  # stdlib also accepts bytes
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+try:
+    import liburing  # optional, Linux only: async appends via io_uring
+    _URING_AVAILABLE = True
+except Exception:
+    liburing = None
+    _URING_AVAILABLE = False
+
 
 def _ensure_dir(p: Path) -> None:
     p.parent.mkdir(parents=True, exist_ok=True)
 
 
+FLUSH_LINES = 256   # write once this many lines are buffered …
+FLUSH_SECS  = 1.0   # … or at least this often, so the dashboard keeps seeing fresh data
+
+
+class _FileSink:
+    """Default backend: plain buffered file, one write()+flush per batch."""
+
+    def __init__(self, path: Path):
+        self._f = path.open("ab")  # lines are already UTF-8 bytes
+
+    def write(self, data: bytes) -> None:
+        self._f.write(data)
+        self._f.flush()
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class _UringSink:
+    """io_uring backend: each batch is queued as one async write SQE.
+
+    At most one write is in flight, so batches land in order on the O_APPEND
+    fd; the previous completion is reaped when the next batch is submitted
+    (normally long done by then) and on close.
+    """
+
+    def __init__(self, path: Path, entries: int = 8):
+        self._ring, self._cqe = liburing.Ring(), liburing.Cqe()
+        liburing.io_uring_queue_init(entries, self._ring)
+        try:
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except Exception:
+            liburing.io_uring_queue_exit(self._ring)
+            raise
+        self._inflight: bytes | None = None  # keeps the buffer alive until its CQE
+
+    def write(self, data: bytes) -> None:
+        self._reap()
+        sqe = liburing.io_uring_get_sqe(self._ring)
+        liburing.io_uring_prep_write(sqe, self._fd, data, 0)  # offset ignored with O_APPEND
+        liburing.io_uring_submit(self._ring)
+        self._inflight = data
+
+    def _reap(self) -> None:
+        if self._inflight is None:
+            return
+        data, self._inflight = self._inflight, None
+        liburing.io_uring_wait_cqe(self._ring, self._cqe)
+        res = self._cqe[0].res
+        liburing.io_uring_cqe_seen(self._ring, self._cqe[0])
+        if res < 0:
+            raise OSError(-res, os.strerror(-res))
+        view = memoryview(data)[res:]
+        while view:  # short write: finish the tail synchronously
+            view = view[os.write(self._fd, view):]
+
+    def close(self) -> None:
+        try:
+            self._reap()
+        finally:
+            liburing.io_uring_queue_exit(self._ring)
+            os.close(self._fd)
+
+
+def _open_sink(path: Path, backend: str = "auto"):
+    if backend in ("auto", "uring") and _URING_AVAILABLE:
+        try:
+            return _UringSink(path)
+        except Exception as e:  # old kernel, seccomp, ...
+            print(f"[subscriber] io_uring unavailable ({e}); using buffered writes")
+    elif backend == "uring":
+        print("[subscriber] liburing not installed; using buffered writes")
+    return _FileSink(path)
+
+
+class _JsonlWriter:
+    """Append-only JSONL sink that batches lines into one write+flush.
+
+    on_message (paho network thread) appends; a daemon timer flushes partial
+    batches so a slow topic still reaches disk within FLUSH_SECS.
+    """
+
+    def __init__(self, path: Path, backend: str = "auto"):
+        self._sink = _open_sink(path, backend)
+        self._buf: list[bytes] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._tick, daemon=True)
+        self._timer.start()
+
+    def append(self, line: bytes) -> None:
+        with self._lock:
+            self._buf.append(line)
+            if len(self._buf) >= FLUSH_LINES:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if self._buf:
+            self._sink.write(b"".join(self._buf))
+            self._buf.clear()
+
+    def _tick(self) -> None:
+        while not self._stop.wait(FLUSH_SECS):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._timer.join(timeout=FLUSH_SECS)
+        try:
+            self.flush()
+        finally:
+            self._sink.close()
+
+
 def run(args):
     outp = Path(args.out)
     _ensure_dir(outp)
-    f = outp.open("a", encoding="utf-8", newline="\n")
+    out = _JsonlWriter(outp, args.writer)
 
     client = mqtt.Client()
 
@@ -30,11 +165,11 @@ def run(args):
         c.subscribe(args.topic, qos=args.qos)
 
     def on_message(c, userdata, msg):
-        raw = msg.payload.decode("utf-8", errors="replace")
         now = datetime.now().strftime("%H:%M:%S")
         try:
-            obj = json.loads(raw)
+            obj = _json_loads(msg.payload)
         except Exception:
+            raw = msg.payload.decode("utf-8", errors="replace")
             print(f"[subscriber] non-JSON @ {now}: {raw[:120]}")
             return
 
@@ -54,10 +189,8 @@ def run(args):
         pw  = obj.get("power_mw") or obj.get("power")
         print(f"[msg] {fac} @ {ts} | P={pw}")
 
-        # Append one clean JSON line
-        line = json.dumps(obj, ensure_ascii=False)
-        f.write(line + "\n")
-        f.flush()
+        # Append one clean JSON line (buffered; see _JsonlWriter)
+        out.append(_json_dumps(obj) + b"\n")
 
     client.on_connect = on_connect
     client.on_message = on_message
@@ -70,7 +203,7 @@ def run(args):
         print("\n[subscriber] stopped by user")
     finally:
         try:
-            f.close()
+            out.close()  # writes whatever is still buffered
         except Exception:
             pass
 
@@ -82,6 +215,8 @@ def build_parser():
     ap.add_argument("--topic", required=True)
     ap.add_argument("--qos", type=int, default=1, choices=[0, 1, 2])
     ap.add_argument("--out", type=Path, default=Path("output/sub_received.jsonl"))
+    ap.add_argument("--writer", default="auto", choices=["auto", "buffered", "uring"],
+                    help="JSONL write backend; auto uses io_uring when liburing is available")
     return ap
 
 